@@ -1,17 +1,24 @@
+import atexit  # Shutting down shared resources when the script exits
 import concurrent.futures  # For creating threadpool for multithreading users
+import functools  # Caching of repeated formatting
 import logging  # Logging tool for writing output to file
 import logging.handlers  # Logging handlers for stdout printing
 import os
+import queue  # Queue feeding log records to the background log writer
+import shelve  # Persistent on-disk cache of updated channels
 import sys  # Operating system endpoints
 import threading
 import time  # Time library for measuring performance
-from itertools import chain  # Iteration tool for iterating complex lists
+from typing import Iterable, Iterator, NamedTuple, Optional  # Type hints
+from urllib.parse import parse_qs, urlencode, urlsplit  # Building page URLs
 
+import orjson  # Fast JSON encoding and decoding of request bodies
 import requests  # Networking library for python
+from requests.adapters import HTTPAdapter  # Connection pooling for the shared session
+from urllib3.util.retry import Retry  # Retry policy for transient Canvas errors
 from canvasapi import (
     Canvas,
     account,  # Canvas API Library for python
-    course,
     exceptions,
 )
 from dotenv import load_dotenv
@@ -24,20 +31,37 @@ from dotenv import load_dotenv
 env_file_path = os.path.join(os.getcwd(), ".env")
 load_dotenv(dotenv_path=env_file_path)
 
-TERM_IDS = sys.argv[1].split(",")  # Read Term IDs from Command line input
+TERM_IDS: list[str] = []  # Term IDs, read from the command line when run as a script
 API_URL = os.environ.get("CANVAS_URL")  # Assign API URL from Configuration file
 API_KEY = os.environ.get("CANVAS_API_KEY")  # Assign API KEY from Configuration file
 
-HEADERS = {  # Headers to be included with each request
-    "Content-type": "application/json",  # Data type to submit to Canvas
-    "Authorization": f"Bearer {API_KEY}",  # Authorisation using API Key
-}
+# Canvas API endpoints, the API URL is resolved once and the ids are filled in per request
+COURSES_URL = (API_URL or "") + (
+    "api/v1/accounts/{account_id}/courses?enrollment_term_id={term_id}&per_page=100"
+)
+COURSE_USERS_URL = (API_URL or "") + (
+    "api/v1/courses/{course_id}/users?enrollment_type[]={enrolment_type}&per_page=100"
+)
+CHANNELS_URL = (API_URL or "") + (
+    "api/v1/users/{user_id}/communication_channels?per_page=100"
+)
+PREFERENCES_URL = (API_URL or "") + (
+    "api/v1/users/{user_id}/communication_channels/{channel_id}/notification_preferences"
+)
+UPDATE_URL = (API_URL or "") + (
+    "api/v1/users/self/communication_channels/{channel_id}/notification_preferences"
+)
+MASQUERADE_QUERY = "?as_user_id={user_id}"  # Makes an update on behalf of the user
 
 TIMEOUT_SECONDS = {  # Timeouts for reading data in and out of a request
     "in": 5,
     "out": 5,
 }
 
+# Statuses where canvas rejected the bulk preference update itself, rather than the
+# request. Only these are retried one preference at a time
+BULK_REJECTED_STATUSES = frozenset({400, 422})
+
 NOTIFICATION_OPTIONS = {  # Canvas notification options
     0: "never",  # NEVER notify
     1: "immediately",  # IMMEDIATELY notify
@@ -47,9 +71,11 @@ NOTIFICATION_OPTIONS = {  # Canvas notification options
 
 ENROLLMENT_TYPES = {0: "observer"}  # Canvas user types  # Observer type user
 
-EXCLUDED_NOTIFICATIONS = (  # Notification categories to exclude
-    "confirm_sms_communication_channel",
-    "account_user_notification",
+EXCLUDED_NOTIFICATIONS = frozenset(  # Notification categories to exclude
+    {
+        "confirm_sms_communication_channel",
+        "account_user_notification",
+    }
 )
 
 CANVAS_ACCOUNT = os.getenv(
@@ -58,8 +84,59 @@ CANVAS_ACCOUNT = os.getenv(
 
 LOG_LEVEL = logging.INFO  # Set the logging level for the terminal and the logfile
 
-MAX_THREADS = 20  # Number of threads to use in multithreading
-FILE_LOCK = threading.Lock()  # Locks the log file for writing
+MAX_THREADS = int(
+    os.getenv("MAX_THREADS", 20)
+)  # Number of concurrent requests to Canvas (DEFAULT => 20)
+
+# Shared HTTP session, reuses keep-alive connections across all worker threads
+SESSION = requests.Session()  # Headers are added in main once the API key is validated
+_ADAPTER = HTTPAdapter(
+    pool_connections=MAX_THREADS,
+    pool_maxsize=MAX_THREADS * 4,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),  # Rate limited or server errors
+        allowed_methods=frozenset(["GET", "PUT"]),
+        respect_retry_after_header=True,  # Wait as long as Canvas asks when throttled
+        raise_on_status=False,  # Return the final response once retries run out
+    ),
+)
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+# Every request made through the session takes a slot, so no more than MAX_THREADS
+# requests are in flight however many pools are busy
+REQUEST_SLOTS = threading.BoundedSemaphore(MAX_THREADS)
+
+# Shared pool for the top level work of each phase (terms, courses and users), created once
+# for the whole run. Work which waits on other work runs on the dedicated pools below, so
+# a full pool can never be left waiting on itself
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_THREADS, thread_name_prefix="canvas"
+)
+atexit.register(EXECUTOR.shutdown)
+
+# Shared pool for retrieving the pages of paginated endpoints, created once for the whole run
+PAGE_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_THREADS, thread_name_prefix="page"
+)
+atexit.register(PAGE_POOL.shutdown)
+
+# Shared pool for updating channels, created once for the whole run
+CHANNEL_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_THREADS, thread_name_prefix="channel"
+)
+atexit.register(CHANNEL_POOL.shutdown)
+
+# On-disk cache of results from previous runs: channels already set to the desired
+# preference, users without channels, and the users of each course
+PREFERENCE_CACHE_FILE = "pref_cache.db"
+PREFERENCE_CACHE: Optional[shelve.Shelf] = None  # Opened by main for the run
+CACHE_LOCK = threading.Lock()  # Locks the preference cache for reading and writing
+COURSE_CACHE_SECONDS = 3600  # How long a course's cached users are reused for
+NO_CHANNELS_CACHE_SECONDS = 3600  # How long users without channels are skipped for
+CLEAR_CACHE = False  # Set from the command line to ignore results from previous runs
 
 #############################################################################################
 ## Custom Exceptions
@@ -94,6 +171,18 @@ class CanvasAccountException(BaseNotifierException):
     """An error retrieving the Nominated account"""
 
 
+#############################################################################################
+## Data Types
+#############################################################################################
+
+
+class CanvasUser(NamedTuple):
+    """A Canvas user, as returned when listing the users of a course"""
+
+    id: int
+    name: str
+
+
 #############################################################################################
 # Configure the logger
 # ===================
@@ -105,10 +194,16 @@ rootLogger.setLevel(LOG_LEVEL)
 
 fileHandler = logging.FileHandler("logfile.log")
 fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
 
 consoleHandler = logging.StreamHandler(sys.stdout)
-rootLogger.addHandler(consoleHandler)
+
+# Worker threads only enqueue records, a background listener writes them out
+logQueue: queue.SimpleQueue = queue.SimpleQueue()
+rootLogger.addHandler(logging.handlers.QueueHandler(logQueue))
+logListener = logging.handlers.QueueListener(
+    logQueue, fileHandler, consoleHandler, respect_handler_level=True
+)
+logListener.start()
 # ===================
 
 #############################################################################################
@@ -116,6 +211,16 @@ rootLogger.addHandler(consoleHandler)
 #############################################################################################
 
 
+def build_headers(api_key: str) -> dict[str, str]:
+    """
+    Builds the headers to be included with each request made to canvas.
+    """
+    return {
+        "Content-type": "application/json",  # Data type to submit to Canvas
+        "Authorization": f"Bearer {api_key}",  # Authorisation using API Key
+    }
+
+
 def connect_to_canvas(api_domain: str, api_key: str) -> Canvas:
     """
     Connects to canvas instance and returns an object which is able to
@@ -123,8 +228,8 @@ def connect_to_canvas(api_domain: str, api_key: str) -> Canvas:
     """
 
     # Print action to console
-    rootLogger.info(f"Accessing: {api_domain}")
-    rootLogger.info(f"Using API key {api_key}...\n")
+    rootLogger.info("Accessing: %s", api_domain)
+    rootLogger.info("Using API key %s...\n", api_key)
 
     try:
         canvas = Canvas(api_domain, api_key)
@@ -171,97 +276,236 @@ def get_account(canvas_connection: Canvas, account_number: int) -> account.Accou
     return user_account
 
 
+def get_page(url: str) -> requests.Response:
+    """
+    Retrieves a single page of a paginated Canvas API endpoint through the shared session.
+
+    Raises:
+        requests.exceptions.HTTPError: The page was returned with an error status
+    """
+    with REQUEST_SLOTS:
+        response = SESSION.get(
+            url, timeout=(TIMEOUT_SECONDS["in"], TIMEOUT_SECONDS["out"])
+        )
+    response.raise_for_status()
+    return response
+
+
+def get_last_page_number(response: requests.Response) -> Optional[int]:
+    """
+    Reads the number of the last page from the Link header Canvas returns with a page.
+    Returns None if Canvas did not provide a numbered last page.
+    """
+    last_url = response.links.get("last", {}).get("url")
+    if last_url is None:
+        return None
+
+    page = parse_qs(urlsplit(last_url).query).get("page", [""])[0]
+    return int(page) if page.isdigit() else None
+
+
+def set_page_number(url: str, page: int) -> str:
+    """
+    Returns the url with its page query parameter set to the given page number.
+    """
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    query["page"] = [str(page)]
+    return parts._replace(query=urlencode(query, doseq=True)).geturl()
+
+
+def get_pages(url: str) -> Iterator[list[dict]]:
+    """
+    Yields every page of a paginated Canvas API endpoint. When the first page reports
+    the number of the last page, the remaining pages are all requested at the same time,
+    otherwise the "next" link Canvas returns with each page is followed.
+
+    Raises:
+        requests.exceptions.HTTPError: A page was returned with an error status
+    """
+    response = get_page(url)
+    yield orjson.loads(response.content)
+
+    last_page = get_last_page_number(response)
+    if last_page is not None:
+        page_futures = [
+            PAGE_POOL.submit(get_page, set_page_number(url, page))
+            for page in range(2, last_page + 1)
+        ]
+        for future in page_futures:
+            yield orjson.loads(future.result().content)
+        return
+
+    next_url = response.links.get("next", {}).get("url")
+    while next_url:
+        response = get_page(next_url)
+        yield orjson.loads(response.content)
+        next_url = response.links.get("next", {}).get("url")
+
+
+def get_all_pages(url: str) -> list[dict]:
+    """
+    Retrieves every page of a paginated Canvas API endpoint through the shared session.
+
+    Raises:
+        requests.exceptions.HTTPError: A page was returned with an error status
+
+    Returns:
+        list[dict]: The JSON objects from every page
+    """
+    return [item for page in get_pages(url) for item in page]
+
+
 def display_term_ids(TERM_IDS):
     """
     Documents the term id's which are being operated on.
     """
     rootLogger.info("Accessing Term IDs:")
     for term_id in TERM_IDS:
-        rootLogger.info(f"{'-':^10}{term_id}\n")
+        rootLogger.info("    -     %s\n", term_id)
 
 
-def get_courses_by_term_ids(canvas_account: account.Account):
+def get_courses_by_term_ids(canvas_account: account.Account) -> Iterator[dict]:
     """
     Retrieves the courses in the given term, the courses which are accessed must be visible
     from the account which has been set by CANVAS_ACCOUNT. This is most effectual when an
-    Admin account is used.
+    Admin account is used. Courses are yielded as each page arrives from canvas, so that
+    work on them can start before every term has finished paginating.
     """
 
     # Variables
-    course_list: list[course.Course] = list()
+    course_queue: queue.Queue = queue.Queue()
+    term_finished = object()  # Marks the end of a term's courses on the queue
 
-    # Iterate over terms and retrieve a course
-    # Expand out the list of courses for each term and concatenate to
-    # the previous terms courses
-    for term_id in TERM_IDS:
-        course_list = list(
-            chain(
-                course_list,
-                canvas_account.get_courses(per_page=500, enrollment_term_id=term_id),
-            )
-        )
-    return course_list
+    def threaded_terms(term_id):
+        try:
+            for page in get_pages(
+                COURSES_URL.format(account_id=canvas_account.id, term_id=term_id)
+            ):
+                # Only the id and name are used, let the rest of each course go
+                for term_course in page:
+                    course_queue.put(
+                        {"id": term_course["id"], "name": term_course["name"]}
+                    )
+        finally:
+            course_queue.put(term_finished)
+
+    # Retrieve the courses for each term at the same time, each term is
+    # paginated independently. Pass on each course as soon as it is retrieved
+    futures = [EXECUTOR.submit(threaded_terms, term_id) for term_id in TERM_IDS]
+
+    remaining_terms = len(futures)
+    while remaining_terms:
+        term_course = course_queue.get()
+        if term_course is term_finished:
+            remaining_terms -= 1
+        else:
+            yield term_course
+
+    # Raise any error which occurred while retrieving a term
+    for future in futures:
+        future.result()
 
 
-def get_user_ids(all_courses: list[course.Course], user_type: str) -> list[int]:
+def get_user_ids(all_courses: Iterable[dict], user_type: str) -> dict[int, str]:
     """
-    For each course, finds and retrieves the user ID for each of the chosen user type.
+    For each course, finds and retrieves the user ID and name for each of the chosen
+    user type. Users enrolled in more than one course are only returned once.
     """
 
     # Variables
-    all_user_ids = list()
-    start_time = time.time()
+    all_user_ids: dict[int, str] = dict()
+    users_lock = threading.Lock()  # Locks the unique users for updating
+    start_time = time.perf_counter()
 
     # Formatting for log file
     rootLogger.info("Courses\n" + "=" * 60)
 
-    def threaded_courses(chosen_course) -> list[int]:
+    def threaded_courses(chosen_course):
         course_observer_ids = get_course_user_ids(chosen_course, user_type)
+        with users_lock:
+            all_user_ids.update(course_observer_ids)
         rootLogger.info(
-            f'{"-":^10}{chosen_course.name :<50} : {len(course_observer_ids) :>5} {user_type}'
+            "    -     %-50s : %5d %s",
+            chosen_course["name"],
+            len(course_observer_ids),
+            user_type,
         )
-        return course_observer_ids
 
-    # Iterate over all courses, find users of nominated type
-    # add these users to a large list of users
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        results = executor.map(threaded_courses, all_courses)
+    # Iterate over all courses as they are retrieved, find users of nominated type
+    # add these users to the collection of unique users
+    futures = [
+        EXECUTOR.submit(threaded_courses, chosen_course)
+        for chosen_course in all_courses
+    ]
 
-    for result in results:
-        all_user_ids = result + all_user_ids
+    # Raise any error which occurred while retrieving a course's users
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
 
-    rootLogger.info(
-        f"Finished in: {time.asctime(time.localtime(time.time() - start_time)) :>20}"
-    )
+    elapsed = time.perf_counter() - start_time
+    rootLogger.info("Finished in: %.2fs", elapsed)
 
     return all_user_ids
 
 
-def get_course_user_ids(canvas_course: course.Course, enrolment_type: str):
+def get_course_user_ids(canvas_course: dict, enrolment_type: str) -> dict[int, str]:
     """
-    For a course, retrieve all users of a particular user type. These user types are
-    defined in the ENROLMENT_TYPES.
+    For a course, retrieve the ID and name of all users of a particular user type.
+    These user types are defined in the ENROLMENT_TYPES. Users retrieved for the course
+    within the last COURSE_CACHE_SECONDS are reused without contacting canvas.
     """
-    course_user_ids = list()
-    users = canvas_course.get_users(enrollment_type=enrolment_type)
+    cached_users = get_cached_course_users(canvas_course["id"], enrolment_type)
+    if cached_users is not None:
+        return cached_users
+
+    pages = get_pages(
+        COURSE_USERS_URL.format(
+            course_id=canvas_course["id"], enrolment_type=enrolment_type
+        )
+    )
 
-    for user in users:
-        course_user_ids.append(user.id)
+    # Read each page straight into the mapping, without joining the pages first
+    course_users = {user["id"]: user["name"] for page in pages for user in page}
 
-    return course_user_ids
+    cache_course_users(canvas_course["id"], enrolment_type, course_users)
+    return course_users
 
 
-def remove_duplicates(user_list) -> set[int]:
+def get_cached_course_users(
+    course_id: int, enrolment_type: str
+) -> Optional[dict[int, str]]:
     """
-    Removes duplicate user ids from the list of users
-    this is achieved by converting to set, which cannot have duplicates
+    Checks the preference cache for the users of a course which were retrieved recently.
+    Returns None if there are none, or they are older than COURSE_CACHE_SECONDS.
     """
-    return set(user_list)
+    with CACHE_LOCK:
+        cached = PREFERENCE_CACHE.get(f"course:{course_id}:{enrolment_type}")
+
+    if cached is None:
+        return None
 
+    cached_at, course_users = cached
+    if time.time() - cached_at > COURSE_CACHE_SECONDS:
+        return None
 
-def iterate_users(
-    canvas_instance: Canvas, user_list: set[int], notification_setting: str
+    return course_users
+
+
+def cache_course_users(
+    course_id: int, enrolment_type: str, course_users: dict[int, str]
 ):
+    """
+    Records in the preference cache the users of a course, and when they were retrieved.
+    """
+    with CACHE_LOCK:
+        PREFERENCE_CACHE[f"course:{course_id}:{enrolment_type}"] = (
+            time.time(),
+            course_users,
+        )
+
+
+def iterate_users(user_list: dict[int, str], notification_setting: str):
     """
     Iterates over the list and updates each user's notification settings
     """
@@ -269,40 +513,68 @@ def iterate_users(
     # Variables
     user_count = len(user_list)
     current_user = 0
+    user_queue: queue.Queue = queue.Queue(maxsize=MAX_THREADS * 4)
+    no_more_users = object()  # Tells a worker that every user has been handed out
 
     rootLogger.info(
-        "\n"
-        + "=" * 60
-        + f"\n Total: {len(user_list)} observers"
-        + "\n"
-        + "=" * 60
-        + "\n"
+        "\n%s\n Total: %d observers\n%s\n", "=" * 60, len(user_list), "=" * 60
     )
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = [
-            executor.submit(
-                submit_user_for_change, id, canvas_instance, notification_setting
-            )
-            for id in user_list
-        ]
+    def threaded_users():
+        while (user := user_queue.get()) is not no_more_users:
+            try:
+                submit_user_for_change(user, notification_setting)
+            except Exception:
+                # Keep the worker alive so the rest of the queue is still drained
+                rootLogger.exception(
+                    "An error occurred updating %s (ID: %s)", user.name, user.id
+                )
+
+    # Start a fixed set of workers, then feed them users through the bounded queue.
+    # Adding to the queue blocks while it is full, so users are handed out only as
+    # quickly as the workers can update them
+    workers = [EXECUTOR.submit(threaded_users) for _ in range(MAX_THREADS)]
 
-        # Execute the futures which are being processed
-        concurrent.futures.wait(futures)
+    try:
+        for id, name in user_list.items():
+            user_queue.put(CanvasUser(id, name))
+    except BaseException:
+        # Feeding was interrupted, drop the users still waiting so the workers stop
+        # after the user they are currently updating
+        while True:
+            try:
+                user_queue.get_nowait()
+            except queue.Empty:
+                break
+        raise
+    finally:
+        # Always tell every worker to stop, so none are left waiting on the queue
+        for _ in workers:
+            user_queue.put(no_more_users)
 
+        # Wait for the workers to finish the remaining users
+        concurrent.futures.wait(workers)
 
-def submit_user_for_change(
-    user_id: int, canvas_instance: Canvas, notification_setting: str
-):
+
+def submit_user_for_change(user: CanvasUser, notification_setting: str):
     """Function which prints information about current user,
     then sends the user's account for the notification settings to be changed.
 
     Args:
-        user_id (int): _description_
+        user (CanvasUser): ID and name of the user to update
     """
+    # Skip users which a previous run found to have no communication channels
+    if is_user_cached_without_channels(user.id):
+        rootLogger.info(
+            "    -     %s (ID: %s) - No channels, skipped.\n%s",
+            user.name,
+            user.id,
+            "=" * 60,
+        )
+        return
+
     # Variables
-    start_time = time.time()
-    user = canvas_instance.get_user(user_id)
+    start_time = time.perf_counter()
     canvas_output: list[str] = []
 
     canvas_output.append(f"{'-':^10}{user.name} (ID: {user.id})")
@@ -315,15 +587,16 @@ def submit_user_for_change(
         canvas_output.append(text)
 
     canvas_output.append(
-        f"User change time: {time.time() - start_time} seconds\n" + "=" * 60
+        f"User change time: {time.perf_counter() - start_time:.2f} seconds\n" + "=" * 60
     )
 
-    for output in canvas_output:
-        with FILE_LOCK:
-            rootLogger.info(output)
+    # Log the user's lines as one record, so lines from other users can't interleave
+    rootLogger.info("%s", "\n".join(canvas_output))
 
 
-def update_user_notification_preferences(user, desired_preference) -> list[str]:
+def update_user_notification_preferences(
+    user: CanvasUser, desired_preference
+) -> list[str]:
     """
     For each user gathers the communication channels which they are subscribed to, then
     updates their communication preferences with the selected communication preference.
@@ -332,82 +605,263 @@ def update_user_notification_preferences(user, desired_preference) -> list[str]:
 
     # Variables
     text_output: list[str] = []
-    channels = user.get_communication_channels()
+    frequency = {"frequency": desired_preference}  # Shared by every preference update
+    single_payload = orjson.dumps({"notification_preferences": [frequency]})
+
+    # Get the communication channels for the user
+    try:
+        channels = get_all_pages(CHANNELS_URL.format(user_id=user.id))
+    except requests.exceptions.HTTPError as channels_status_error:
+        text_output.append(
+            f"{'-':^10}{'Unable to retrieve channels.':<45} ( FAILED - {channels_status_error.response.status_code} )"
+        )
+        return text_output
+    except (
+        requests.exceptions.Timeout,  # Request times out
+        requests.exceptions.ProxyError,  # Proxy settings preventing channel acquisition
+        requests.exceptions.ConnectionError,  # Connection is lost
+    ) as user_channel_error:
+        rootLogger.error(
+            "An error occurred retrieving communication channels for: %s", user.name
+        )
+        rootLogger.exception(user_channel_error)
+        return text_output
+
+    if not channels:
+        cache_user_without_channels(user.id)
+        text_output.append(f"{'-':^10}{'No channels to update.':<45}")
+        return text_output
+
+    # Update each of the user's channels at the same time on the shared channel pool
+    channel_futures = [
+        CHANNEL_POOL.submit(
+            update_channel_preferences,
+            user,
+            channel,
+            desired_preference,
+            frequency,
+            single_payload,
+        )
+        for channel in channels
+    ]
+
+    # Retrieve all results from threads, keeping the order of the channels
+    for future in channel_futures:
+        text_output.extend(future.result())
+
+    # Return all text outputs
+    return text_output
+
+
+def update_channel_preferences(
+    user: CanvasUser,
+    channel: dict,
+    desired_preference: str,
+    frequency: dict[str, str],
+    single_payload: bytes,
+) -> list[str]:
+    """
+    Retrieves the notification preferences for one of a user's communication channels,
+    then updates every preference which is not yet set to the desired preference with a
+    single bulk request.
+    """
+
+    # Variables
+    text_output: list[str] = []
 
-    for channel in channels:
-        # Append output to output list
-        text_output.append(f"{'-':^10} {channel}")
+    # Append output to output list
+    text_output.append(
+        f"{'-':^10} {channel.get('address') or channel['type']} ({channel['id']})"
+    )
 
-        # Get the notification preferences for a channel
-        try:
-            response = requests.get(
-                f"{API_URL}api/v1/users/{user.id}/communication_channels/{channel.id}/notification_preferences",
-                headers=HEADERS,
+    # Skip channels which a previous run has already updated
+    if is_channel_cached(user.id, channel["id"], desired_preference):
+        text_output.append(f"{'-':^10}{'Cached, no preferences to update.':<45}")
+        return text_output
+
+    # Get the notification preferences for a channel
+    try:
+        with REQUEST_SLOTS:
+            response = SESSION.get(
+                PREFERENCES_URL.format(user_id=user.id, channel_id=channel["id"]),
                 timeout=(TIMEOUT_SECONDS["in"], TIMEOUT_SECONDS["out"]),
             )
-        except (
-            requests.exceptions.Timeout,  # Request times out
-            requests.exceptions.ProxyError,  # Proxy settings preventing channel acquisition
-            requests.exceptions.HTTPError,  # Http error occurred during channel acquisition
-        ) as user_channel_error:
-            rootLogger.error(
-                "An error occurred retrieving notification preferences for:%s's - %s channel.",
-                user.name,
-                channel,
-            )
-            rootLogger.exception(user_channel_error)
+    except (
+        requests.exceptions.Timeout,  # Request times out
+        requests.exceptions.ProxyError,  # Proxy settings preventing channel acquisition
+        requests.exceptions.ConnectionError,  # Connection is lost
+    ) as user_channel_error:
+        rootLogger.error(
+            "An error occurred retrieving notification preferences for:%s's - %s channel.",
+            user.name,
+            channel.get("address") or channel["type"],
+        )
+        rootLogger.exception(user_channel_error)
+        return text_output
 
-        else:
-            preferences = response.json()["notification_preferences"]
-            # Filter the preferences that don't match the desired_preference
-            preferences = [
-                pref
-                for pref in preferences
-                if pref["frequency"] != desired_preference
-                and not (pref["notification"] in EXCLUDED_NOTIFICATIONS)
-            ]
-
-            if not (len(preferences) > 0):
-                text_output.append(f"{'-':^10}{'No Preferences to update.':<45}")
-                return text_output
-
-            # Create thread executor and create pool of execution threads
-            with concurrent.futures.ThreadPoolExecutor(
-                max_workers=len(preferences)
-            ) as submission_executor:
-                submission_futures = [
-                    submission_executor.submit(
-                        send_to_canvas, user, desired_preference, channel, preference
-                    )
-                    for preference in preferences
-                ]
+    if not response.ok:
+        text_output.append(
+            f"{'-':^10}{'Unable to retrieve preferences.':<45} ( FAILED - {response.status_code} )"
+        )
+        return text_output
+
+    preferences = orjson.loads(response.content)["notification_preferences"]
+
+    # Build the update for the preferences that don't match the desired_preference,
+    # keeping the order canvas returned them in
+    already_set = {
+        pref["notification"]
+        for pref in preferences
+        if pref["frequency"] == desired_preference
+    }
+    to_update = {
+        pref["notification"]: frequency
+        for pref in preferences
+        if pref["notification"] not in EXCLUDED_NOTIFICATIONS
+        and pref["notification"] not in already_set
+    }
+
+    if not to_update:
+        cache_channel_preference(user.id, channel["id"], desired_preference)
+        text_output.append(f"{'-':^10}{'No Preferences to update.':<45}")
+        return text_output
+
+    # Resolve the channel's update URL and the masquerade query once for every request
+    channel_url = UPDATE_URL.format(channel_id=channel["id"])
+    user_query = MASQUERADE_QUERY.format(user_id=user.id)
+
+    # Send every outstanding preference for the channel in a single request
+    response = send_bulk_to_canvas(channel_url, user_query, to_update)
+
+    if response is None:
+        text_output.append(
+            f"{'-':^10}{'Unable to update preferences.':<45} ( FAILED - no response )"
+        )
+        return text_output
 
-                # Run all futures
-                concurrent.futures.wait(submission_futures)
+    if response.ok:
+        cache_channel_preference(user.id, channel["id"], desired_preference)
+        for notification in to_update:
+            text_output.append(
+                format_update_result(notification, desired_preference, response)
+            )
+    elif response.status_code in BULK_REJECTED_STATUSES:
+        # Canvas rejected the bulk update, fall back to updating each preference
+        all_updated = True
+        for notification in to_update:
+            response = send_to_canvas(
+                channel_url, user_query, notification, single_payload
+            )
+            if response is None:
+                all_updated = False
+                continue
+            all_updated = all_updated and response.ok
+            text_output.append(
+                format_update_result(notification, desired_preference, response)
+            )
 
-            # Retrieve all results from threads
-            for future in submission_futures:
-                text_output.append(future.result())
+        if all_updated:
+            cache_channel_preference(user.id, channel["id"], desired_preference)
+    else:
+        # Unauthorised, or still throttled once the session's retries ran out. Sending
+        # each preference individually would only add to the load on canvas
+        text_output.append(
+            f"{'-':^10}{'Unable to update preferences.':<45} ( {format_status(response.status_code, response.ok)} )"
+        )
+        return text_output
 
-            text_output.append("All updates sent.")
+    text_output.append("All updates sent.")
 
-    # Return all text outputs
     return text_output
 
 
-def send_to_canvas(user, desired_preference, channel, preference) -> str:
+def is_channel_cached(user_id: int, channel_id: int, desired_preference: str) -> bool:
+    """
+    Checks the preference cache to see if the channel has already been set to the
+    desired preference on a previous run.
+    """
+    with CACHE_LOCK:
+        return PREFERENCE_CACHE.get(f"{user_id}:{channel_id}") == desired_preference
+
+
+def cache_channel_preference(user_id: int, channel_id: int, desired_preference: str):
+    """
+    Records in the preference cache that the channel is set to the desired preference.
+    """
+    with CACHE_LOCK:
+        PREFERENCE_CACHE[f"{user_id}:{channel_id}"] = desired_preference
+
+
+def is_user_cached_without_channels(user_id: int) -> bool:
+    """
+    Checks the preference cache to see if a previous run found the user to have no
+    communication channels, within the last NO_CHANNELS_CACHE_SECONDS.
+    """
+    with CACHE_LOCK:
+        cached = PREFERENCE_CACHE.get(f"{user_id}:no_channels")
+
+    # Entries recorded without a timestamp are treated as expired
+    if not isinstance(cached, tuple):
+        return False
+
+    cached_at, _ = cached
+    return time.time() - cached_at <= NO_CHANNELS_CACHE_SECONDS
+
+
+def cache_user_without_channels(user_id: int):
+    """
+    Records in the preference cache that the user has no communication channels, and
+    when this was found.
+    """
+    with CACHE_LOCK:
+        PREFERENCE_CACHE[f"{user_id}:no_channels"] = (time.time(), True)
+
+
+def send_bulk_to_canvas(
+    channel_url: str, user_query: str, to_update: dict[str, dict[str, str]]
+):
     """
-    Sends the notification preference for a particular chanel to the Canvas server
+    Sends all of the given notification preferences for a channel to the Canvas server
+    in a single request. Returns the response, or None if the request could not be made.
     """
-    payload = {"notification_preferences": [{"frequency": desired_preference}]}
+    payload = orjson.dumps({"notification_preferences": to_update})
 
     try:
-        response = requests.put(
-            f"{API_URL}api/v1/users/self/communication_channels/{channel.id}/notification_preferences/{preference['notification']}?as_user_id={user.id}",
-            headers=HEADERS,
-            json=payload,
-            timeout=(TIMEOUT_SECONDS["in"], TIMEOUT_SECONDS["out"]),
+        with REQUEST_SLOTS:
+            response = SESSION.put(
+                channel_url + user_query,
+                data=payload,
+                timeout=(TIMEOUT_SECONDS["in"], TIMEOUT_SECONDS["out"]),
+            )
+    except (
+        requests.exceptions.Timeout,  # Request times out
+        requests.exceptions.ProxyError,  # Proxy settings preventing channel aquisition
+        requests.exceptions.ConnectionError,  # Connection is lost
+    ) as update_settings_error:
+        rootLogger.exception(
+            "An error occured with the requests module preventing bulk settings update"
         )
+        rootLogger.exception(update_settings_error)
+        return None
+
+    return response
+
+
+def send_to_canvas(
+    channel_url: str, user_query: str, notification: str, payload: bytes
+):
+    """
+    Sends the notification preference for a particular chanel to the Canvas server.
+    Returns the response, or None if the request could not be made.
+    """
+
+    try:
+        with REQUEST_SLOTS:
+            response = SESSION.put(
+                channel_url + "/" + notification + user_query,
+                data=payload,
+                timeout=(TIMEOUT_SECONDS["in"], TIMEOUT_SECONDS["out"]),
+            )
     except (
         requests.exceptions.Timeout,  # Request times out
         requests.exceptions.ProxyError,  # Proxy settings preventing channel aquisition
@@ -417,9 +871,24 @@ def send_to_canvas(user, desired_preference, channel, preference) -> str:
             "An error occured with the requests module preventing settings update"
         )
         rootLogger.exception(update_settings_error)
-        return
+        return None
+
+    return response
+
+
+def format_update_result(notification: str, desired_preference, response) -> str:
+    """
+    Formats the outcome of a preference update for the log output
+    """
+    return f'{"-":^10}{notification:<45}{"=> " + desired_preference:>10} ( {format_status(response.status_code, response.ok)} )'
+
 
-    return f'{"-":^10}{preference["notification"]:<45}{"=> " + desired_preference:>10} ( {"OK" if response.ok else f"FAILED - {response.status_code}"} )'
+@functools.lru_cache(maxsize=None)
+def format_status(status_code: int, ok: bool) -> str:
+    """
+    Formats a response status for the log output, each status is only formatted once
+    """
+    return "OK" if ok else f"FAILED - {status_code}"
 
 
 #############################################################################################
@@ -434,58 +903,84 @@ def main():
         InvalidConfigurationException:
             Signals that the configuration of the .env file is incorrect
     """
+    global PREFERENCE_CACHE
 
-    # Variables
-    program_start = time.time()
-    chosen_notification_option = os.getenv("NOTIFICATION_OPTION")
-    chosen_enrolment = os.getenv("ENROLMENT_OPTION")
-    print(os.getenv("API_URL"))
-
-    # Validate correct configuration
-    if chosen_notification_option is None:
-        raise InvalidConfigurationException(
-            "No Notification has been chosen in the configuration file."
-        )
-    if chosen_enrolment is None:
-        raise InvalidConfigurationException(
-            "No user enrolment has been configured in the configuration file."
-        )
-    if API_KEY is None or API_URL is None:
-        raise InvalidConfigurationException(
-            "No API URL or API kEY specified, please check the configuration"
-        )
-    if CANVAS_ACCOUNT is None:
-        raise InvalidConfigurationException(
-            "No Canvas account chosen masquerading changes, check configuration."
-        )
+    try:
+        # Variables
+        program_start = time.perf_counter()
+        chosen_notification_option = os.getenv("NOTIFICATION_OPTION")
+        chosen_enrolment = os.getenv("ENROLMENT_OPTION")
+        print(os.getenv("API_URL"))
+
+        # Validate correct configuration
+        if chosen_notification_option is None:
+            raise InvalidConfigurationException(
+                "No Notification has been chosen in the configuration file."
+            )
+        if chosen_enrolment is None:
+            raise InvalidConfigurationException(
+                "No user enrolment has been configured in the configuration file."
+            )
+        if API_KEY is None or API_URL is None:
+            raise InvalidConfigurationException(
+                "No API URL or API kEY specified, please check the configuration"
+            )
+        if CANVAS_ACCOUNT is None:
+            raise InvalidConfigurationException(
+                "No Canvas account chosen masquerading changes, check configuration."
+            )
 
-    # Output to user start of program
-    rootLogger.info("Program start...")
+        # Open the results of previous runs, forgetting them when asked to from the
+        # command line
+        PREFERENCE_CACHE = shelve.open(PREFERENCE_CACHE_FILE)
+        if CLEAR_CACHE:
+            with CACHE_LOCK:
+                PREFERENCE_CACHE.clear()
+            rootLogger.info("Cleared cached results from previous runs.")
 
-    canvas_instance = connect_to_canvas(API_URL, API_KEY)
-    admin_account = get_account(canvas_instance, int(CANVAS_ACCOUNT))
+        # Authenticate every request made through the shared session
+        SESSION.headers.update(build_headers(API_KEY))
 
-    # Print to user term information
-    display_term_ids(TERM_IDS)
+        # Output to user start of program
+        rootLogger.info("Program start...")
 
-    # Load Courses and retrieve users from those courses
-    # Remove duplicates from the list
-    courses_in_term = get_courses_by_term_ids(admin_account)
-    all_users = get_user_ids(courses_in_term, ENROLLMENT_TYPES[int(chosen_enrolment)])
-    all_users = remove_duplicates(all_users)
+        canvas_instance = connect_to_canvas(API_URL, API_KEY)
+        admin_account = get_account(canvas_instance, int(CANVAS_ACCOUNT))
 
-    # Iterate over users and update their notification settings
-    iterate_users(
-        canvas_instance,
-        all_users,
-        NOTIFICATION_OPTIONS[int(chosen_notification_option)],
-    )
+        # Print to user term information
+        display_term_ids(TERM_IDS)
 
-    # Show end of program
-    rootLogger.info(
-        "Program completed, and took: %f seconds", time.time() - program_start
-    )
+        # Load Courses and retrieve the unique users from those courses
+        courses_in_term = get_courses_by_term_ids(admin_account)
+        all_users = get_user_ids(
+            courses_in_term, ENROLLMENT_TYPES[int(chosen_enrolment)]
+        )
+
+        # Iterate over users and update their notification settings
+        iterate_users(
+            all_users,
+            NOTIFICATION_OPTIONS[int(chosen_notification_option)],
+        )
+
+        # Show end of program
+        rootLogger.info(
+            "Program completed, and took: %.2f seconds",
+            time.perf_counter() - program_start,
+        )
+    finally:
+        # Let work already running on the pools finish and drop work not yet started,
+        # outer pools first as their work waits on the inner pools
+        for pool in (EXECUTOR, CHANNEL_POOL, PAGE_POOL):
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        # Write the cache to disk even if the run failed, then write out every queued
+        # log record before the script exits
+        if PREFERENCE_CACHE is not None:
+            PREFERENCE_CACHE.close()
+        logListener.stop()
 
 
 if __name__ == "__main__":
+    TERM_IDS = sys.argv[1].split(",")  # Read Term IDs from Command line input
+    CLEAR_CACHE = "--no-cache" in sys.argv[2:]  # Ignore results from previous runs
     main()